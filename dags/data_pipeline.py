@@ -1,27 +1,31 @@
 from __future__ import annotations
 import os
+import gzip
 import io
-import csv
+import contextlib
+import functools
+import queue
+import threading
 from datetime import datetime, timezone
 
 from airflow import DAG
 from datetime import datetime, timedelta
-from airflow.operators.python import PythonOperator
+from airflow.sdk import task
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 
 # Config
-SHARED_DIR = os.environ.get("SHARED_DIR", "/shared")  
 GCS_BUCKET = os.environ.get('GCS_BUCKET', 'finure-airflow')
 GCS_INPUT_BLOB = os.environ.get('INPUT_FILE_PATH', 'datasets/in/dataset.csv')
 GCS_OUTPUT_PREFIX = os.environ.get('OUTPUT_FILE_PREFIX', 'datasets/out')
 GCS_REJECT_PREFIX = os.environ.get("REJECT_FILE_PREFIX", 'datasets/reject')
 SLACK_WEBHOOK_URL = os.environ.get('SLACK_WEBHOOK_URL')  
 ARGO_WEBHOOK_URL = os.environ.get('ARGO_WEBHOOK_URL')
-
-# Validation
-CREDIT_SCORE_MIN = 0
-CREDIT_SCORE_MAX = 850
+GCS_CHUNK_SIZE = 8 * 1024 * 1024  # bytes per ranged read / resumable upload request, multiple of 256 KiB
 
 default_args = {
     "owner": "finure-data-platform",
@@ -37,221 +41,180 @@ with DAG(
     tags=["gcs", "validation", "slack"],
 ) as dag:
 
-    def _download_from_gcs(**context):
-        """Download input CSV to tmp file and pass the file path via XCom"""
-        client = storage.Client()  # ADC via GKE Workload Identity
-        bucket = client.bucket(GCS_BUCKET)
-        blob = bucket.blob(GCS_INPUT_BLOB)
-        data = blob.download_as_bytes()
-
-        in_path = f"{SHARED_DIR}/input.csv"
-        os.makedirs(os.path.dirname(in_path), exist_ok=True)
-        with open(in_path, "wb") as f:
-            f.write(data)
-        context["ti"].xcom_push(key="input_csv_path", value=in_path)
-
-    def _validate_and_clean(**context):
-        """Read input CSV, validate/clean, write cleaned and rejects to /tmp, push paths via XCom"""
-        in_path = context["ti"].xcom_pull(key="input_csv_path") or f"{SHARED_DIR}/input.csv"
-        if not os.path.exists(in_path):
-            raise FileNotFoundError(f"Input CSV not found at expected shared path: {in_path}")
-
-        with open(in_path, "r", encoding="utf-8", newline="") as f:
-            text = f.read()
-
-        REQUIRED_COLS = ["Age", "Income", "Employed", "CreditScore", "LoanAmount"]
-        OPTIONAL_COLS = ["Approved"]
-
-        reader = csv.reader(io.StringIO(text))
-        rows = list(reader)
-        if not rows:
-            raise ValueError("Input CSV is empty")
-
-        raw_header = [h.strip() for h in rows[0]]
-        has_header = all(c in raw_header for c in REQUIRED_COLS)
-
-        if has_header:
-            header = raw_header
-            data_rows = rows[1:]
-        else:
-            header = REQUIRED_COLS + OPTIONAL_COLS 
-            data_rows = rows
-
-        col_index = {c: (header.index(c) if c in header else None) for c in (REQUIRED_COLS + OPTIONAL_COLS)}
-        missing_required = [c for c in REQUIRED_COLS if col_index[c] is None]
-        if has_header and missing_required:
-            raise ValueError(f"Missing required columns: {missing_required}")
-
-        cleaned = []
-        rejected = []
-
-        def parse_int(val, allow_any_len=False, min_len=None, max_len=None, allow_negative=True):
-            sval = ("" if val is None else str(val).strip())
-            if sval == "":
-                return None, "missing"
-            if sval.startswith("-"):
-                if not allow_negative:
-                    return None, "negative_not_allowed"
-                if not sval[1:].isdigit():
-                    return None, "not_integer"
-            elif not sval.isdigit():
-                return None, "not_integer"
-            ival = int(sval)
-            if not allow_any_len:
-                digits = len(str(abs(ival)))
-                if min_len is not None and digits < min_len:
-                    return None, f"too_short_len<{min_len}"
-                if max_len is not None and digits > max_len:
-                    return None, f"too_long_len>{max_len}"
-            return ival, None
-
-        def get_val(row, col):
-            idx = col_index[col]
-            if idx is None or idx >= len(row):
-                return None
-            return row[idx]
-
-        for r_i, row in enumerate(data_rows, start=1):
-            reasons = []
-
-            age_raw = get_val(row, "Age")
-            age, err = parse_int(age_raw, allow_any_len=False, min_len=2, max_len=3, allow_negative=False)
-            if err:
-                reasons.append(f"Age:{err}")
-
-            income_raw = get_val(row, "Income")
-            income, err = parse_int(income_raw, allow_any_len=True)
-            if err:
-                reasons.append(f"Income:{err}")
-
-            emp_raw = get_val(row, "Employed")
-            employed, err = parse_int(emp_raw, allow_any_len=True, allow_negative=False)
-            if err:
-                reasons.append(f"Employed:{err}")
-                employed = None
-            else:
-                if employed not in (0, 1):
-                    reasons.append("Employed:not_0_or_1")
-
-            cs_raw = get_val(row, "CreditScore")
-            cs, err = parse_int(cs_raw, allow_any_len=True, allow_negative=False)
-            if err:
-                reasons.append(f"CreditScore:{err}")
-            else:
-                if not (CREDIT_SCORE_MIN <= cs <= CREDIT_SCORE_MAX):
-                    reasons.append("CreditScore:out_of_range")
-
-            la_raw = get_val(row, "LoanAmount")
-            loan_amt, err = parse_int(la_raw, allow_any_len=True)
-            if err:
-                reasons.append(f"LoanAmount:{err}")
-
-            appr_raw = get_val(row, "Approved")
-            approved = ""
-            if appr_raw is not None and str(appr_raw).strip() != "":
-                a_val, a_err = parse_int(appr_raw, allow_any_len=True, allow_negative=False)
-                if a_err:
-                    reasons.append(f"Approved:{a_err}")
-                else:
-                    if a_val not in (0, 1):
-                        reasons.append("Approved:not_0_or_1")
-                    else:
-                        approved = a_val
-
-            required_missing = any(v is None for v in [age, income, employed, cs, loan_amt])
-            if reasons or required_missing:
-                rejected.append(
-                    {"row_number": r_i, "row": row, "reasons": reasons or ["required_missing"]}
-                )
-                continue
-
-            cleaned.append(
-                {
-                    "Age": age,
-                    "Income": income,
-                    "Employed": employed,
-                    "CreditScore": cs,
-                    "LoanAmount": loan_amt,
-                    "Approved": approved,
-                }
-            )
-
-        # Write cleaned back to /tmp
-        cleaned_path = f"{SHARED_DIR}/cleaned.csv"
-        with open(cleaned_path, "w", encoding="utf-8", newline="") as f:
-            writer = csv.writer(f, lineterminator="\n")
-            writer.writerow(["Age", "Income", "Employed", "CreditScore", "LoanAmount", "Approved"])
-            for rec in cleaned:
-                writer.writerow([
-                    rec["Age"], rec["Income"], rec["Employed"], rec["CreditScore"], rec["LoanAmount"], rec["Approved"]
-                ])
-
-        # Write rejects to /tmp
-        rejects_path = f"{SHARED_DIR}/rejected.csv"
-        with open(rejects_path, "w", encoding="utf-8", newline="") as f:
-            rej_writer = csv.writer(f, lineterminator="\n")
-            rej_writer.writerow(["row_number", "reasons", "raw_row"])
-            for rej in rejected:
-                rej_writer.writerow([
-                    rej["row_number"],
-                    ";".join(rej["reasons"]),
-                    "|".join("" if x is None else str(x) for x in rej["row"])
-                ])
-
-        stats = {
-            "total_rows_including_header": len(rows),
-            "data_rows_evaluated": len(data_rows),
-            "clean_rows": len(cleaned),
-            "rejected_rows": len(rejected),
-        }
-
-        ti = context["ti"]
-        in_path = ti.xcom_pull(task_ids="download_from_gcs", key="input_csv_path") or f"{SHARED_DIR}/input.csv"
-        ti.xcom_push(key="cleaned_csv_path", value=cleaned_path)
-        ti.xcom_push(key="rejected_csv_path", value=rejects_path)
-        ti.xcom_push(key="validation_stats", value=stats)
+    class _BackgroundUpload(io.RawIOBase):
+        """Write-only stream that hands GCS_CHUNK_SIZE pieces to a thread writing them to an upload stream
+
+        Each output gets its own thread, so both uploads run concurrently and while the next batches are
+        validated. The thread only starts with the first full piece, after the validation workers have been
+        forked, and at most two pieces are queued so memory stays bounded when the upload falls behind.
+        """
+
+        def __init__(self, target):
+            self._target = target
+            self._pending = bytearray()
+            self._queue = queue.Queue(maxsize=2)
+            self._thread = None
+            self._error = None
+            self._written = 0
+
+        def writable(self):
+            return True
+
+        def tell(self):
+            return self._written
+
+        def write(self, b):
+            self._raise_upload_error()
+            self._pending += b
+            self._written += len(b)
+            if len(self._pending) >= GCS_CHUNK_SIZE:
+                self._hand_off()
+            return len(b)
+
+        def close(self):
+            if not self.closed:
+                try:
+                    if self._pending:
+                        self._hand_off()
+                    if self._thread is not None:
+                        self._queue.put(None)
+                        self._thread.join()
+                finally:
+                    super().close()
+            self._raise_upload_error()
+
+        def _hand_off(self):
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._drain, daemon=True)
+                self._thread.start()
+            self._queue.put(bytes(self._pending))
+            self._pending.clear()
+
+        def _drain(self):
+            # Keeps consuming after a failure so the writer never blocks on a full queue
+            while (piece := self._queue.get()) is not None:
+                if self._error is None:
+                    try:
+                        self._target.write(piece)
+                    except Exception as e:
+                        self._error = e
+
+        def _raise_upload_error(self):
+            if self._error is not None:
+                raise self._error
+
+    @task(task_id="validate_and_clean")
+    def validate_and_clean():
+        """Stream input CSV from GCS through validation straight into cleaned and rejects objects, return paths and stats"""
+        # Imported here so parsing the DAG does not load numpy and pyarrow. The validation core lives
+        # next to this file, and the DAGs folder is on sys.path
+        from csv_validation import OUTPUT_FORMAT, read_header, validate_stream
 
-    def _upload_to_gcs(**context):
-        ti = context["ti"]
         ts = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
-        cleaned_path = ti.xcom_pull(task_ids="validate_and_clean", key="cleaned_csv_path") or f"{SHARED_DIR}/cleaned.csv"
-        rejected_path = ti.xcom_pull(task_ids="validate_and_clean", key="rejected_csv_path") or f"{SHARED_DIR}/rejected.csv"
+        if OUTPUT_FORMAT not in ("parquet", "csv"):
+            raise ValueError(f"Unsupported OUTPUT_FORMAT: {OUTPUT_FORMAT!r}")
 
-        if not cleaned_path or not os.path.exists(cleaned_path):
-            raise FileNotFoundError(f"Cleaned CSV path missing or not found: {cleaned_path!r}")
-        if not rejected_path or not os.path.exists(rejected_path):
-            raise FileNotFoundError(f"Rejected CSV path missing or not found: {rejected_path!r}")
-
-        client = storage.Client()
+        client = storage.Client()  # ADC via GKE Workload Identity
         bucket = client.bucket(GCS_BUCKET)
         base = os.path.basename(GCS_INPUT_BLOB)
         base_noext = base.rsplit(".", 1)[0]
         out_prefix = GCS_OUTPUT_PREFIX.rstrip("/") + "/"
         rej_prefix = GCS_REJECT_PREFIX.rstrip("/") + "/"
 
-        cleaned_name = f"{out_prefix}{base_noext}_clean_{ts}.csv"
-        rejects_name = f"{rej_prefix}{base_noext}_rejects_{ts}.csv"
-
-        with open(cleaned_path, "rb") as f:
-            bucket.blob(cleaned_name).upload_from_file(f, content_type="text/csv")
-        with open(rejected_path, "rb") as f:
-            bucket.blob(rejects_name).upload_from_file(f, content_type="text/csv")
-
-        ti.xcom_push(key="cleaned_object_path", value=cleaned_name)
-        ti.xcom_push(key="rejects_object_path", value=rejects_name)
+        # CSV outputs are stored gzip-compressed
+        cleaned_ext = "csv.gz" if OUTPUT_FORMAT == "csv" else OUTPUT_FORMAT
+        cleaned_name = f"{out_prefix}{base_noext}_clean_{ts}.{cleaned_ext}"
+        rejects_name = f"{rej_prefix}{base_noext}_rejects_{ts}.csv.gz"
+
+        # The first row is peeked off the input stream to decide on header vs data, and the CSV reader
+        # carries on from the same stream so the object is only downloaded once
+        source_blob = bucket.blob(GCS_INPUT_BLOB)
+        src = io.BufferedReader(source_blob.open("rb", chunk_size=GCS_CHUNK_SIZE))
+        header, has_header, first_line = read_header(src)
+
+        cleaned_blob = bucket.blob(cleaned_name)
+        rejects_blob = bucket.blob(rejects_name)
+        rejects_blob.content_encoding = "gzip"
+        if OUTPUT_FORMAT == "csv":
+            cleaned_blob.content_encoding = "gzip"
+        out_options = {"chunk_size": GCS_CHUNK_SIZE, "ignore_flush": True}
+        cleaned_type = "application/vnd.apache.parquet" if OUTPUT_FORMAT == "parquet" else "text/csv"
+
+        def gzipped(f):
+            # Level 1 compresses faster than the upload drains, while still shrinking integer CSVs several times
+            return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=1)
+
+        # Rows stream from the input object through validation into resumable uploads of both outputs,
+        # so only a few blocks are ever held in memory and nothing touches local disk. Each upload is
+        # fed from its own background thread
+        try:
+            with src, \
+                    cleaned_blob.open("wb", content_type=cleaned_type, **out_options) as clean_f, \
+                    rejects_blob.open("wb", content_type="text/csv", **out_options) as rej_f, \
+                    _BackgroundUpload(clean_f) as clean_bg, \
+                    _BackgroundUpload(rej_f) as rej_bg, \
+                    (gzipped(clean_bg) if OUTPUT_FORMAT == "csv" else contextlib.nullcontext(clean_bg)) as clean_out, \
+                    gzipped(rej_bg) as rej_out:
+                stats = validate_stream(src, header, has_header, first_line, clean_out, rej_out)
+        except Exception:
+            # Closing an upload stream commits whatever was written, so drop the partial outputs again
+            for blob in (cleaned_blob, rejects_blob):
+                with contextlib.suppress(NotFound):
+                    blob.delete()
+            raise
+
+        # Returned as one XCom so downstream tasks need a single pull
+        return {
+            "cleaned_object_path": cleaned_name,
+            "rejects_object_path": rejects_name,
+            "validation_stats": stats,
+        }
 
-    def _notify_argo(**context):
+    # The notify tasks run even when validation fails, so they pull the result themselves
+    # instead of taking it as an argument, which would fail them when it is missing
+    def _validation_result(ti):
+        return ti.xcom_pull(task_ids="validate_and_clean") or {}
+
+    @functools.lru_cache(maxsize=None)
+    def _webhook_session(retry_responses):
+        """Keep-alive session for the webhook calls, retrying connection errors with backoff
+
+        With retry_responses, timeouts and 429/5xx responses are retried too. Argo Events may have
+        accepted an event it still answers with a 5xx or too late, and a repeat would start the
+        workflow twice, so only the Slack message is sent that way.
+        """
+        if retry_responses:
+            retry = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset({"POST"}),
+            )
+        else:
+            # Connection errors happen before the request reaches the server, so they are safe to repeat
+            retry = Retry(total=3, connect=3, read=0, other=0, status=0, backoff_factor=0.5)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _post_json(url, payload, retry_responses=False):
+        resp = _webhook_session(retry_responses).post(url, json=payload, timeout=10)
+        resp.raise_for_status()
+        return resp
+
+    @task(task_id="notify_argo", trigger_rule="all_done")
+    def notify_argo(ti=None):
         """Send a notification to Argo with the produced object paths"""
-        import json, urllib.request
-        ti = context["ti"]
-
         webhook = ARGO_WEBHOOK_URL
         if not webhook:
             print("ARGO_WEBHOOK_URL not set, skipping Argo notify")
             return
 
-        cleaned_obj = ti.xcom_pull(task_ids="upload_to_gcs", key="cleaned_object_path")
-        rejects_obj = ti.xcom_pull(task_ids="upload_to_gcs", key="rejects_object_path")
+        result = _validation_result(ti)
+        cleaned_obj = result.get("cleaned_object_path")
+        rejects_obj = result.get("rejects_object_path")
 
         payload = {
             "bucket": GCS_BUCKET,
@@ -261,25 +224,18 @@ with DAG(
             "timestamp_utc": datetime.now(timezone.utc).isoformat(),
         }
 
-        req = urllib.request.Request(
-            webhook,
-            data=json.dumps(payload).encode("utf-8"),
-            headers={"Content-Type": "application/json"},
-            method="POST",
-        )
         try:
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                print(f"Argo notify status: {resp.status}")
+            resp = _post_json(webhook, payload)
+            print(f"Argo notify status: {resp.status_code}")
         except Exception as e:
             print(f"Argo notify failed: {e}")
 
-    def _slack_report(**context):
-        import json, urllib.request
-        ti = context["ti"]
-
-        stats = ti.xcom_pull(task_ids="validate_and_clean", key="validation_stats") or {}
-        cleaned_obj = ti.xcom_pull(task_ids="upload_to_gcs", key="cleaned_object_path")
-        rejects_obj = ti.xcom_pull(task_ids="upload_to_gcs", key="rejects_object_path")
+    @task(task_id="slack_report", trigger_rule="all_done")
+    def slack_report(ti=None):
+        result = _validation_result(ti)
+        stats = result.get("validation_stats") or {}
+        cleaned_obj = result.get("cleaned_object_path")
+        rejects_obj = result.get("rejects_object_path")
 
         webhook = SLACK_WEBHOOK_URL  
         if not webhook:
@@ -303,39 +259,11 @@ with DAG(
             + "\n".join(lines)
         )
 
-        data = json.dumps({"text": msg}).encode("utf-8")
-        req = urllib.request.Request(webhook, data=data, headers={"Content-Type": "application/json"}, method="POST")
         try:
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                print(f"Slack status: {resp.status}")
+            resp = _post_json(webhook, {"text": msg}, retry_responses=True)
+            print(f"Slack status: {resp.status_code}")
         except Exception as e:
             print(f"Slack notify failed: {e}")
 
-    download = PythonOperator(
-        task_id="download_from_gcs",
-        python_callable=_download_from_gcs,
-    )
-
-    validate_clean = PythonOperator(
-        task_id="validate_and_clean",
-        python_callable=_validate_and_clean,
-    )
-
-    upload = PythonOperator(
-        task_id="upload_to_gcs",
-        python_callable=_upload_to_gcs,
-    )
-
-    argo_notify = PythonOperator(
-        task_id="notify_argo",
-        python_callable=_notify_argo,
-        trigger_rule="all_done",
-    )
-
-    slack = PythonOperator(
-        task_id="slack_report",
-        python_callable=_slack_report,
-        trigger_rule="all_done",
-    )
-
-    download >> validate_clean >> upload >> argo_notify >> slack
+    validate_and_clean() >> notify_argo() >> slack_report()
+
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The DAGs folder is what Airflow puts on sys.path, so the tests import the validation core the same way
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "dags"))
@@ -0,0 +1,209 @@
+import csv
+import io
+
+import pyarrow.parquet as pq
+import pytest
+
+import csv_validation
+
+HEADER = b"Age,Income,Employed,CreditScore,LoanAmount,Approved\n"
+
+
+@pytest.fixture
+def validate(monkeypatch):
+    """Run read_header and validate_stream on in-memory CSV bytes, return (stats, cleaned rows, rejected rows)"""
+    monkeypatch.setattr(csv_validation, "VALIDATION_WORKERS", 1)
+
+    def run(data, **settings):
+        for name, value in settings.items():
+            monkeypatch.setattr(csv_validation, name, value)
+        src = io.BufferedReader(io.BytesIO(data))
+        clean_out, rej_out = io.BytesIO(), io.BytesIO()
+        header, has_header, first_line = csv_validation.read_header(src)
+        stats = csv_validation.validate_stream(src, header, has_header, first_line, clean_out, rej_out)
+        cleaned = [list(r.values()) for r in pq.read_table(io.BytesIO(clean_out.getvalue())).to_pylist()]
+        rejected = list(csv.reader(io.StringIO(rej_out.getvalue().decode("utf-8"))))
+        assert rejected[0] == ["row_number", "reasons", "raw_row"]
+        return stats, cleaned, [(int(n), reasons, raw) for n, reasons, raw in rejected[1:]]
+
+    return run
+
+
+def test_all_ragged_rows_are_validated_in_bounded_batches(validate, monkeypatch):
+    # Arrow yields no batch at all when every row of a block has the wrong field count
+    batch_sizes = []
+    validate_batch = csv_validation._validate_batch
+
+    def spy(batch, col_index, width):
+        batch_sizes.append(batch.num_rows)
+        return validate_batch(batch, col_index, width)
+
+    monkeypatch.setattr(csv_validation, "_validate_batch", spy)
+    rows = [f"{'x' if i % 10 == 0 else 30},{i},1,700,5,1,extra" for i in range(1, 2001)]
+    data = HEADER + "\n".join(rows).encode() + b"\n"
+
+    stats, cleaned, rejected = validate(data, MALFORMED_BATCH_ROWS=100)
+
+    assert stats == {
+        "total_rows_including_header": 2001,
+        "data_rows_evaluated": 2000,
+        "clean_rows": 1800,
+        "rejected_rows": 200,
+    }
+    assert [r[1] for r in cleaned] == [i for i in range(1, 2001) if i % 10]
+    assert rejected == [(i, "Age:not_integer", f"x|{i}|1|700|5|1|extra") for i in range(10, 2001, 10)]
+    assert sum(batch_sizes) == 2000
+    assert len(batch_sizes) > 1 and max(batch_sizes) < 4 * 100
+
+
+# Expected values are what the pre-Arrow, row-by-row csv.reader implementation reported for the same input
+ROWS = (
+    b"25,5000,1,700,1000,1\n"
+    b",abc,2,-5,1.5,x\n"
+    b"5,-1,1,900,0,\n"
+    b"30,1,1,1\n"
+    b"\n"
+    b"30,1,1,700,5,1,extra,more\n"
+    b'"30",100,0,"7\n00",5,0\n'
+    b"1234,1,1,700,5,1\n"
+    b" 40 ,1,1,700,5,\n"
+)
+CLEANED = [[25, 5000, 1, 700, 1000, 1], [30, 1, 1, 700, 5, 1], [40, 1, 1, 700, 5, None]]
+REJECTED = [
+    (
+        2,
+        "Age:missing;Income:not_integer;Employed:not_0_or_1;CreditScore:negative_not_allowed;"
+        "LoanAmount:not_integer;Approved:not_integer",
+        "|abc|2|-5|1.5|x",
+    ),
+    (3, "Age:too_short_len<2;CreditScore:out_of_range", "5|-1|1|900|0|"),
+    (4, "LoanAmount:missing", "30|1|1|1"),
+    # Arrow parses a blank line as a row of empty fields, where the old implementation kept ""
+    (5, "Age:missing;Income:missing;Employed:missing;CreditScore:missing;LoanAmount:missing", "|||||"),
+    (7, "CreditScore:not_integer", "30|100|0|7\n00|5|0"),
+    (8, "Age:too_long_len>3", "1234|1|1|700|5|1"),
+]
+
+
+def test_reasons_and_row_numbers(validate):
+    stats, cleaned, rejected = validate(HEADER + ROWS)
+
+    assert stats == {
+        "total_rows_including_header": 10,
+        "data_rows_evaluated": 9,
+        "clean_rows": 3,
+        "rejected_rows": 6,
+    }
+    assert cleaned == CLEANED
+    assert rejected == REJECTED
+
+
+def test_headerless_input(validate):
+    stats, cleaned, rejected = validate(ROWS)
+
+    assert stats == {
+        "total_rows_including_header": 9,
+        "data_rows_evaluated": 9,
+        "clean_rows": 3,
+        "rejected_rows": 6,
+    }
+    assert cleaned == CLEANED
+    assert rejected == REJECTED
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_multi_block_input(validate, workers):
+    copies = 50
+    stats, cleaned, rejected = validate(HEADER + ROWS * copies, CSV_BLOCK_SIZE=256, VALIDATION_WORKERS=workers)
+
+    assert stats == {
+        "total_rows_including_header": 9 * copies + 1,
+        "data_rows_evaluated": 9 * copies,
+        "clean_rows": 3 * copies,
+        "rejected_rows": 6 * copies,
+    }
+    assert cleaned == CLEANED * copies
+    assert rejected == [(num + 9 * i, reasons, raw) for i in range(copies) for num, reasons, raw in REJECTED]
+
+
+def test_empty_input():
+    with pytest.raises(ValueError, match="empty"):
+        csv_validation.read_header(io.BufferedReader(io.BytesIO(b"")))
+
+
+
+def test_failed_output_stops_reading_input(monkeypatch):
+    class FailingSink(io.BytesIO):
+        def write(self, b):
+            if self.tell() + len(b) > 1024:
+                raise OSError("upload failed")
+            return super().write(b)
+
+    monkeypatch.setattr(csv_validation, "VALIDATION_WORKERS", 1)
+    monkeypatch.setattr(csv_validation, "CSV_BLOCK_SIZE", 64 * 1024)
+    data = HEADER + b"30,1,1,700,5,1\n" * 500_000
+    raw = io.BytesIO(data)
+    src = io.BufferedReader(raw)
+    header, has_header, first_line = csv_validation.read_header(src)
+
+    with pytest.raises(OSError, match="upload failed"):
+        csv_validation.validate_stream(src, header, has_header, first_line, FailingSink(), io.BytesIO())
+    assert raw.tell() < len(data) // 2
+
+
+def test_headerless_first_row_with_quoted_newline(validate):
+    stats, cleaned, rejected = validate(b'"7\n0",1234,1,700,5,1\n30,1,1,700,5,1\nx,1,1,700,5,1\n')
+
+    assert stats["data_rows_evaluated"] == 3
+    assert cleaned == [[30, 1, 1, 700, 5, 1]]
+    assert rejected == [(1, "Age:not_integer", "7\n0|1234|1|700|5|1"), (3, "Age:not_integer", "x|1|1|700|5|1")]
+
+
+def test_headerless_input_without_approved(validate, monkeypatch):
+    reparsed = []
+    validate_batch = csv_validation._validate_batch
+
+    def spy(batch, col_index, width):
+        # Rows parsed by Arrow have a null raw_row, malformed ones re-parsed by csv.reader carry theirs
+        reparsed.append(batch.num_rows - batch.column("raw_row").null_count)
+        return validate_batch(batch, col_index, width)
+
+    monkeypatch.setattr(csv_validation, "_validate_batch", spy)
+    data = b"25,5000,1,700,1000\n30,1,1,700,5,1\n5,x,1,700,5\n30,1,1\n40,1,1,700,5,7\n" + b"30,1,1,700,5\n" * 1000
+
+    stats, cleaned, rejected = validate(data)
+
+    assert stats["clean_rows"] == 1002
+    assert cleaned[:3] == [[25, 5000, 1, 700, 1000, None], [30, 1, 1, 700, 5, 1], [30, 1, 1, 700, 5, None]]
+    assert rejected == [
+        (3, "Age:too_short_len<2;Income:not_integer", "5|x|1|700|5"),
+        (4, "CreditScore:missing;LoanAmount:missing", "30|1|1"),
+        (5, "Approved:not_0_or_1", "40|1|1|700|5|7"),
+    ]
+    # Only the peeked first row and the rows of another width go through on_invalid_row
+    assert sum(reparsed) == 4
+
+
+def test_int64_bounds(validate):
+    rows = [
+        b"30,9223372036854775807,1,700,5,1",
+        b"30,9223372036854775808,1,700,5,1",
+        b"30,-9223372036854775808,1,700,-9223372036854775808,1",
+        b"30,-9223372036854775809,1,700,5,1",
+        b"30,1,1,700,00009223372036854775807,1",
+        b"30,1,1,700,-00009223372036854775809,1",
+        b"30,1,1,700,99999999999999999999999,1",
+    ]
+    stats, cleaned, rejected = validate(HEADER + b"\n".join(rows) + b"\n")
+
+    assert cleaned == [
+        [30, 2 ** 63 - 1, 1, 700, 5, 1],
+        [30, -(2 ** 63), 1, 700, -(2 ** 63), 1],
+        [30, 1, 1, 700, 2 ** 63 - 1, 1],
+    ]
+    assert [(num, reasons) for num, reasons, _ in rejected] == [
+        (2, "Income:out_of_range"),
+        (4, "Income:out_of_range"),
+        (6, "LoanAmount:out_of_range"),
+        (7, "LoanAmount:out_of_range"),
+    ]